@@ -27,6 +27,12 @@
 #include <ulog.h>
 #include <string_view>
 
+#ifdef __AVR__
+#  include <util/crc16.h>
+#else
+#  include <array>
+#endif
+
 #include <boost/sml.hpp>
 
 #include <asx/chrono.hpp>
@@ -67,6 +73,27 @@ namespace asx {
          ignore_frame          = 0xFF  ///< Frame not intented for us
       };
 
+      namespace detail {
+#ifndef __AVR__
+         /// @brief Byte lookup table of the MODBUS CRC-16 (reflected polynomial 0xA001)
+         inline constexpr auto crc_table = []() {
+            std::array<uint16_t, 256> table{};
+
+            for (uint16_t i = 0; i < 256; ++i) {
+               uint16_t crc = i;
+
+               for (uint8_t j=8; j!=0; --j) {
+                  crc = (crc & 1) ? (crc >> 1) ^ 0xA001 : crc >> 1;
+               }
+
+               table[i] = crc;
+            }
+
+            return table;
+         }();
+#endif
+      }
+
       class Crc {
          /// @brief Number of bytes received. Modbus limits to 256 bytes.
          uint8_t count;
@@ -81,9 +108,18 @@ namespace asx {
          Crc();
          void reset();
          void operator()(uint8_t byte);
-         void update(uint8_t byte);
          bool check();
          uint16_t update(std::string_view view);
+
+         /// @brief Add a byte to the CRC. Inline so the callers processing each byte can fold it
+         void update(uint8_t byte) {
+#ifdef __AVR__
+            // avr-libc hand optimised routine for the same polynomial
+            crc = _crc16_update(crc, byte);
+#else
+            crc = (crc >> 8) ^ detail::crc_table[(crc ^ byte) & 0xff];
+#endif
+         }
       };
 
       struct can_start {
@@ -38,7 +38,10 @@ The tuple is made of:
    The parameters are converted to the host representation and cast.
    The size is checked during cast. A range 0-0x200 cannot be cast to an 8-bit.
 """
+import functools
+import itertools
 import re
+from collections import Counter, defaultdict
 
 TEMPLATE_CODE_MASTER="""#pragma once
 /**
@@ -46,6 +49,7 @@ TEMPLATE_CODE_MASTER="""#pragma once
  * uart data used for a modbus RTU.
  */
 #include <cstdint>
+#include <cstring>
 
 #include <ulog.h>
 #include <asx/modbus_rtu_master.hpp>
@@ -85,15 +89,25 @@ namespace @NAMESPACE@ {
         inline static uint8_t expected_command;
 
         static inline auto ntoh(const uint8_t offset) -> uint16_t {
-            return (static_cast<uint16_t>(buffer[offset]) << 8) | static_cast<uint16_t>(buffer[offset + 1]);
+            uint16_t value;
+            memcpy(&value, &buffer[offset], sizeof(value));
+
+            if constexpr ( __BYTE_ORDER__ == __ORDER_LITTLE_ENDIAN__ ) {
+                value = __builtin_bswap16(value);
+            }
+
+            return value;
         }
 
         static inline auto ntohl(const uint8_t offset) -> uint32_t {
-            return
-                (static_cast<uint32_t>(buffer[offset]) << 24) |
-                (static_cast<uint32_t>(buffer[offset+1]) << 16) |
-                (static_cast<uint32_t>(buffer[offset+2]) << 8) |
-                static_cast<uint16_t>(buffer[offset+3]);
+            uint32_t value;
+            memcpy(&value, &buffer[offset], sizeof(value));
+
+            if constexpr ( __BYTE_ORDER__ == __ORDER_LITTLE_ENDIAN__ ) {
+                value = __builtin_bswap32(value);
+            }
+
+            return value;
         }
 
     public:
@@ -132,6 +146,7 @@ namespace @NAMESPACE@ {
             // Keep count
             ++cnt;
 
+            // state_t is dense from 0, so the compiler can dispatch with a jump table
             switch(state) {
             case state_t::ERROR:
                 break;
@@ -161,13 +176,23 @@ namespace @NAMESPACE@ {
             if constexpr ( sizeof(T) == 1 ) {
                 buffer[cnt++] = value;
             } else if constexpr ( sizeof(T) == 2 ) {
-                buffer[cnt++] = value >> 8;
-                buffer[cnt++] = value & 0xff;
+                auto be = static_cast<uint16_t>(value);
+
+                if constexpr ( __BYTE_ORDER__ == __ORDER_LITTLE_ENDIAN__ ) {
+                    be = __builtin_bswap16(be);
+                }
+
+                memcpy(&buffer[cnt], &be, sizeof(be));
+                cnt += sizeof(be);
             } else if constexpr ( sizeof(T) == 4 ) {
-                buffer[cnt++] = value >> 24;
-                buffer[cnt++] = value >> 16 & 0xff;
-                buffer[cnt++] = value >> 8 & 0xff;
-                buffer[cnt++] = value & 0xff;
+                auto be = static_cast<uint32_t>(value);
+
+                if constexpr ( __BYTE_ORDER__ == __ORDER_LITTLE_ENDIAN__ ) {
+                    be = __builtin_bswap32(be);
+                }
+
+                memcpy(&buffer[cnt], &be, sizeof(be));
+                cnt += sizeof(be);
             }
         }
 
@@ -198,8 +223,7 @@ namespace @NAMESPACE@ {
 
         /** Called when a T3.5 has been detected, in a good sequence */
         static void ready_request() noexcept {
-            // Add the CRC
-            crc.reset();
+            // Add the CRC (computed over the whole buffer from a reset)
             auto _crc = crc.update(std::string_view{(char *)buffer, cnt});
             buffer[cnt++] = _crc & 0xff;
             buffer[cnt++] = _crc >> 8;
@@ -225,6 +249,7 @@ TEMPLATE_CODE_SLAVE="""#pragma once
  * the modbus_rtu_slave.cpp file only which will create a full rtu slave device.
  */
 #include <cstdint>
+#include <cstring>
 #include <ulog.h>
 #include <asx/modbus_rtu_slave.hpp>
 
@@ -266,15 +291,25 @@ namespace @NAMESPACE@ {
         inline static asx::modbus::Crc crc{};
 
         static inline auto ntoh(const uint8_t offset) -> uint16_t {
-            return (static_cast<uint16_t>(buffer[offset]) << 8) | static_cast<uint16_t>(buffer[offset + 1]);
+            uint16_t value;
+            memcpy(&value, &buffer[offset], sizeof(value));
+
+            if constexpr ( __BYTE_ORDER__ == __ORDER_LITTLE_ENDIAN__ ) {
+                value = __builtin_bswap16(value);
+            }
+
+            return value;
         }
 
         static inline auto ntohl(const uint8_t offset) -> uint32_t {
-            return
-                (static_cast<uint32_t>(buffer[offset]) << 24) |
-                (static_cast<uint32_t>(buffer[offset+1]) << 16) |
-                (static_cast<uint32_t>(buffer[offset+2]) << 8) |
-                static_cast<uint16_t>(buffer[offset+3]);
+            uint32_t value;
+            memcpy(&value, &buffer[offset], sizeof(value));
+
+            if constexpr ( __BYTE_ORDER__ == __ORDER_LITTLE_ENDIAN__ ) {
+                value = __builtin_bswap32(value);
+            }
+
+            return value;
         }
 
     public:
@@ -315,6 +350,7 @@ namespace @NAMESPACE@ {
                 buffer[cnt++] = c; // Store the data
             }
 
+            // state_t is dense from 0, so the compiler can dispatch with a jump table
             switch(state) {
             case state_t::ERROR:
                 break;
@@ -337,13 +373,23 @@ namespace @NAMESPACE@ {
             if constexpr ( sizeof(T) == 1 ) {
                 buffer[cnt++] = value;
             } else if constexpr ( sizeof(T) == 2 ) {
-                buffer[cnt++] = value >> 8;
-                buffer[cnt++] = value & 0xff;
+                auto be = static_cast<uint16_t>(value);
+
+                if constexpr ( __BYTE_ORDER__ == __ORDER_LITTLE_ENDIAN__ ) {
+                    be = __builtin_bswap16(be);
+                }
+
+                memcpy(&buffer[cnt], &be, sizeof(be));
+                cnt += sizeof(be);
             } else if constexpr ( sizeof(T) == 4 ) {
-                buffer[cnt++] = value >> 24;
-                buffer[cnt++] = value >> 16 & 0xff;
-                buffer[cnt++] = value >> 8 & 0xff;
-                buffer[cnt++] = value & 0xff;
+                auto be = static_cast<uint32_t>(value);
+
+                if constexpr ( __BYTE_ORDER__ == __ORDER_LITTLE_ENDIAN__ ) {
+                    be = __builtin_bswap32(be);
+                }
+
+                memcpy(&buffer[cnt], &be, sizeof(be));
+                cnt += sizeof(be);
             }
         }
 
@@ -383,8 +429,7 @@ namespace @NAMESPACE@ {
                 // Framesize includes the previous CRC which still holds valid
                 cnt = frame_size;
             } else {
-                // Add the CRC
-                crc.reset();
+                // Add the CRC (computed over the whole buffer from a reset)
                 auto _crc = crc.update(std::string_view{(char *)buffer, cnt});
                 buffer[cnt++] = _crc & 0xff;
                 buffer[cnt++] = _crc >> 8;
@@ -404,42 +449,70 @@ namespace @NAMESPACE@ {
     inline void on_diagnostics() {}
 } // namespace @NAMESPACE@"""
 
-# Regex to check the device address (and extract it)
-DEVICE_ADDR_RE = re.compile(r'device@((?:0x)?([0-9a-fA-F]+))')
+# Regex matching the device nodes of the tree, with an optional address
+DEVICE_KEY_RE = re.compile(r'^device(@(?P<addr>0x[0-9a-fA-F]+|\d+))?$')
+
+# Regex of the @NAME@ placeholders of the templates
+PLACEHOLDER_RE = re.compile(r'@(\w+)@')
+
+def to_format_string(template):
+    """
+    Convert a template to a str.format string
+    The braces of the C++ code are escaped, and the @NAME@ placeholders become {NAME} fields
+    """
+    escaped = template.replace("{", "{{").replace("}", "}}")
+    return PLACEHOLDER_RE.sub(r"{\1}", escaped)
 
-# Regex pattern for a valid C function name
-VALID_C_FUNCTION_NAME = re.compile(r'^[a-zA-Z_][a-zA-Z0-9_]*$')
+# Templates converted at import, rendered with str.format_map
+FORMAT_TEMPLATE_MASTER = to_format_string(TEMPLATE_CODE_MASTER)
+FORMAT_TEMPLATE_SLAVE = to_format_string(TEMPLATE_CODE_SLAVE)
 
-# Indent by
-INDENT = " " * 4
+# Default tab size of the generated code
+DEFAULT_TAB_SIZE = 4
+
+# Indent by, by default
+INDENT = " " * DEFAULT_TAB_SIZE
+
+@functools.lru_cache(maxsize=None)
+def _tab(indent_str, n):
+    """ @return The indentation of the given level """
+    return indent_str * n
 
 class Integral:
     """Base class for integral types."""
+    __slots__ = ()
     bits = None
+    size = None
 
     def __init__(self, i):
         """ Set the value """
         self.value = i
 
-    @property
-    def size(self):
-        """Return the size in bytes of the integral type."""
-        return self.bits // 8
+def chain_offsets(chain):
+    """ @return the offset in the frame of each matcher of the chain, followed by the total size """
+    return list(itertools.accumulate((item.size for item in chain), initial=0))
 
 class _8bits(Integral):
+    __slots__ = ()
     bits = 8
+    size = 1
     ctype = "uint8_t"
 
 class _16bits(Integral):
+    __slots__ = ()
     bits = 16
+    size = 2
     ctype = "uint16_t"
 
 class _32bits(Integral):
+    __slots__ = ()
     bits = 32
+    size = 4
     ctype = "uint32_t"
 
 class Matcher:
     """Base Matcher class for different integral types."""
+    __slots__ = ("value", "alias", "pos")
 
     def __init__(self, *args, **kwargs):
         if len(args) == 0 or (len(args) == 1 and args[0] is None):
@@ -466,22 +539,23 @@ class Matcher:
         self.pos = None # To be set later
 
     def __eq__(self, other):
-        if not isinstance(other, Matcher):
-            return False  # Not comparable with non-Matcher types
-
-        # Compare class types
-        if self.__class__ != other.__class__:
+        # Compare class types (which also rules out non-Matcher types)
+        if self.__class__ is not other.__class__:
             return False
 
         # Compare the `value` attribute
-        if type(self.value) != type(other.value):
-            return False
+        sv, ov = self.value, other.value
 
-        if self.value != other.value:
+        if sv.__class__ is not ov.__class__:
             return False
 
-        # If all checks pass, the objects are equal
-        return True
+        return sv == ov
+
+    def __hash__(self):
+        value = self.value
+
+        # Lists are not hashable - hash the values as a tuple
+        return hash((self.__class__, tuple(value) if isinstance(value, list) else value))
 
     def cast(self, value):
         """Check and return the value if valid, otherwise raise an error."""
@@ -494,21 +568,20 @@ class Matcher:
         raise NotImplementedError
 
     def fits(self, item):
-        """ @return False if the item size is fitting with the given matcher """
-        v = item(0)
-
+        """ @return False if the item size is fitting with the given matcher type """
         # Is it big enough!
-        if v.size >= self.size:
+        if item.size >= self.size:
             return True
 
         # 2 cases left 8 for a 16
         if isinstance(self.value, Range):
             # For the range, we need to check if the min and max are fitting
-            return v.min <= self.value._from and v.max >= self.value._to
+            return item.min <= self.value._from and item.max >= self.value._to
         elif isinstance(self.value, list):
             # Make sure all values for within the min-max range
+            lo, hi = item.min, item.max
             for t in self.value:
-                if t < v.min or t > v.max:
+                if t < lo or t > hi:
                     return False
 
         return True
@@ -517,19 +590,29 @@ class Matcher:
         return f"{self.ctype}({self.value})"
 
     def to_code(self):
-        if isinstance(self.value, Range):
-            if self.value._from == 0 and isinstance(self, UnsignedMatcher):
-                return f"c <= {self.value._to}"
-            return f"c >= {self.value._from} and c <= {self.value._to}"
-        elif isinstance(self.value, list):
-            return " || ".join(f"c == {hex(value)}" for value in self.value)
-        elif self.value == None:
-            return None
-        else:
-            return f"c == {self.value}"
+        value = self.value
+
+        # Lists are not hashable - use a tuple as the cache key
+        return matcher_code(self.__class__, tuple(value) if isinstance(value, list) else value)
+
+@functools.lru_cache(maxsize=None)
+def matcher_code(cls, value):
+    """ @return the test for a matcher value. Cached since the same matchers repeat across states """
+    if isinstance(value, Range):
+        if value._from == 0 and issubclass(cls, UnsignedMatcher):
+            return f"c <= {value._to}"
+        return f"c >= {value._from} and c <= {value._to}"
+    elif isinstance(value, tuple):
+        return " || ".join(f"c == {hex(v)}" for v in value)
+    elif value == None:
+        return None
+    else:
+        return f"c == {value}"
 
 class Range:
     """Simple Range class to hold value ranges."""
+    __slots__ = ("_from", "_to")
+
     def __init__(self, from_value, to_value):
         self._from = from_value
         self._to = to_value
@@ -537,45 +620,57 @@ class Range:
         return f"[{self._from}-{self._to}]"
 
     def __eq__(self, other):
-        return self._from == other._from and self._to == other._to
+        return isinstance(other, Range) and (self._from, self._to) == (other._from, other._to)
+
+    def __hash__(self):
+        return hash((self._from, self._to))
 
 class UnsignedMatcher(Matcher):
     """Matcher for unsigned integral types."""
+    __slots__ = ()
+
+    def __init_subclass__(cls, **kwargs):
+        """ Compute the bounds once for each concrete type """
+        super().__init_subclass__(**kwargs)
+        if cls.bits:
+            cls.min = 0
+            cls.max = (1 << cls.bits) - 1
+
     def check(self, value):
-        return isinstance(value, int) and (0 <= value < (1 << self.bits))
-    @property
-    def max(self):
-        return (1 << self.bits) - 1
-    @property
-    def min(self):
-        return 0
+        return isinstance(value, int) and self.min <= value <= self.max
 
 class SignedMatcher(Matcher):
     """Matcher for signed integral types."""
+    __slots__ = ()
+
+    def __init_subclass__(cls, **kwargs):
+        """ Compute the bounds once for each concrete type """
+        super().__init_subclass__(**kwargs)
+        if cls.bits:
+            cls.min = -(1 << (cls.bits - 1))
+            cls.max = (1 << (cls.bits - 1)) - 1
+
     def check(self, value):
-        return isinstance(value, int) and (-(1 << (self.bits - 1)) <= value < (1 << (self.bits - 1)))
-    @property
-    def max(self):
-        return (1 << (self.bits - 1)) - 1
-    @property
-    def min(self):
-        return -(1 << (self.bits - 1))
+        return isinstance(value, int) and self.min <= value <= self.max
 
 # Concrete Matcher classes for various types
-class u8(UnsignedMatcher, _8bits): pass
-class u16(UnsignedMatcher, _16bits): pass
-class u32(UnsignedMatcher, _32bits): pass
-class s8(SignedMatcher, _8bits): pass
-class s16(SignedMatcher, _16bits): pass
-class s32(SignedMatcher, _32bits): pass
+class u8(UnsignedMatcher, _8bits): __slots__ = ()
+class u16(UnsignedMatcher, _16bits): __slots__ = ()
+class u32(UnsignedMatcher, _32bits): __slots__ = ()
+class s8(SignedMatcher, _8bits): __slots__ = ()
+class s16(SignedMatcher, _16bits): __slots__ = ()
+class s32(SignedMatcher, _32bits): __slots__ = ()
 class f32(Matcher, _32bits):
+    __slots__ = ()
     def check(self, value):
         return isinstance(value, float)
 class Crc(UnsignedMatcher, _16bits):
+    __slots__ = ()
     _bits = -16 # Negative for little endian
     def to_code(self):
         return "true"
 class RuntimeDeviceAddress(UnsignedMatcher, _8bits):
+    __slots__ = ()
     def to_code(self):
         return "c == device_address";
 
@@ -639,8 +734,130 @@ MEI_OBJECT_CATEGORY = {
 }
 
 
+# Code fragments emitted for the states. Formatted with str.format where
+# {tab} is the indentation of the enclosing block and {i} a single indent.
+CODE_TRANSITION = "if ( {test} ) {{\n{tab}{i}state = state_t::{next};\n{tab}}}"
+CODE_GOTO = "state = state_t::{next};"
+CODE_CNT_CHECK = "{tab}if ( cnt == {cnt} ) {{\n"
+CODE_CRC_CHECK = CODE_CNT_CHECK + "{tab}{i}state = state_t::{next};"
+CODE_NO_MATCH = " else {{\n{tab}{i}error = error_t::{error};\n{tab}{i}state = state_t::{state};"
+CODE_REDEFINE_C = {
+    2: "{tab}auto c = ntoh(cnt-2);\n\n",
+    4: "{tab}auto c = ntohl(cnt-4);\n\n",
+}
+
+# Byte transitions on exact values are emitted as a switch from that many cases
+SWITCH_MIN_CASES = 3
+CODE_SWITCH = "{tab}switch ( c ) {{\n"
+CODE_SWITCH_CASE = "{tab}case {value}:\n{tab}{i}state = state_t::{next};\n{tab}{i}break;\n"
+CODE_SWITCH_DEFAULT = "{tab}default:\n{tab}{i}error = error_t::{error};\n{tab}{i}state = state_t::{state};"
+
+# Reading of a callback argument from the buffer, by size
+CODE_ARGUMENT = {
+    1: "buffer[{}]",
+    2: "ntoh({})",
+    4: "ntohl({})",
+}
+
+# Error and state to set when no transition matches, by position in the frame
+NO_MATCH_ERRORS = {
+    0: ("ignore_frame", "IGNORE"),
+    1: ("illegal_function_code", "ERROR"),
+}
+NO_MATCH_DEFAULT = ("illegal_data_value", "ERROR")
+
+# Master mode checks of the reply against the request still in the buffer
+CODE_MASTER_ADDRESS_CHECK = (
+    "// The address must match the address just send and still in the buffer\n",
+    "if ( c != buffer[0] ) {\n",
+    "    error = error_t::ignore_frame;\n",
+    "    state = state_t::IGNORE;\n",
+    "    break;\n",
+    "}\n",
+)
+
+CODE_MASTER_COMMAND_CHECK = (
+    "// The command must match the command just sent\n",
+    "if ( c == (0x80 | buffer[1]) ) { // Bit 7 indicate an error\n",
+    "   state = state_t::BAD_REQUEST;\n",
+    "   break;\n",
+    "} else if ( c != buffer[1] ) {\n",
+    "   state = state_t::ERROR;\n",
+    "   break;\n",
+    "}\n\n",
+)
+
+# Answers to the identification requests. Formatted with str.format where
+# {tab} is the indentation of the lines.
+CODE_REPORT_SLAVE_ID = (
+    "{tab}\n/** Answer command 17 - Report slave id */\n"
+    "{tab}inline void on_report_slave_id() {{\n"
+    "{tab}    Datagram::set_size(2); // Reset the count to 2 (ID + code)\n"
+    "{tab}    Datagram::pack<uint8_t>({length}); // Byte count\n"
+    "{tab}    Datagram::pack<uint8_t>({slave_id}); // slave ID\n"
+    "{tab}    Datagram::pack<uint8_t>(0xFF); // Status OK\n"
+    "{tab}    Datagram::pack(\"{id}\"); // Function code\n"
+    "{tab}}}"
+)
+
+CODE_PACK_OBJECT = (
+    "{tab}Datagram::pack<uint8_t>(0x{code:02x}); // Object code\n"
+    "{tab}Datagram::pack<uint8_t>({length}); // Length of the object\n"
+    "{tab}Datagram::pack(\"{data}\");\n"
+)
+
+CODE_READ_ID_HEADER = (
+    "{tab}/** Answer command 43/14 */\n"
+    "{tab} inline void on_read_device_identification(uint8_t device_id, uint8_t object_id) {{\n"
+    "{tab}    Datagram::set_size(4); // Reset the count to 4 (addr/func/mei_type/DevId)\n"
+    "{tab}    Datagram::pack<uint8_t>({level}); // Conformity level\n"
+    "{tab}    Datagram::pack<uint8_t>(0); // No more to follow\n\n"
+    "    Datagram::pack<uint8_t>(0); // Next object ID\n\n"
+)
+
+CODE_READ_ID_BASIC_COUNT = "{tab}Datagram::pack<uint8_t>({l1c}); // {l1c} objects\n"
+
+CODE_READ_ID_REGULAR_COUNT = (
+    "{tab}if (device_id == 1) {{ // Device ID 1 has a fixed number of objects\n"
+    "{tab}   Datagram::pack<uint8_t>({l1c}); // {l1c} objects\n"
+    "{tab}}} else {{\n"
+    "{tab}   Datagram::pack<uint8_t>({l2t}); // {l1c} + {l2c} objects\n"
+    "{tab}}}\n\n"
+)
+
+CODE_READ_ID_EXTENDED_COUNT = (
+    "{tab}if (device_id == 1) {{ // Device ID 1 has a fixed number of objects\n"
+    "{tab}   Datagram::pack<uint8_t>({l1c}); // {l1c} objects\n"
+    "{tab}}} else if (device_id == 2) {{\n"
+    "{tab}   Datagram::pack<uint8_t>({l2t}); // {l1c} + {l2c} objects\n"
+    "{tab}}} else {{\n"
+    "{tab}   Datagram::pack<uint8_t>({l3t}); // {l1c} +  {l2c} + {l3c} objects\n"
+    "{tab}}}\n\n"
+)
+
+# Answer to the read device identification by conformity level. The count of
+# objects, then the blocks packing the objects of a category as
+# (opening line, category, closing line). A block without an opening line
+# packs its objects unconditionally.
+CONFORMITY_PLAN = {
+    BASIC_DEVICE_IDENTIFICATION: (CODE_READ_ID_BASIC_COUNT, (
+        (None, BASIC_DEVICE_IDENTIFICATION, None),
+    )),
+    REGULAR_DEVICE_IDENTIFICATION: (CODE_READ_ID_REGULAR_COUNT, (
+        ("if (device_id >= 1) {\n", BASIC_DEVICE_IDENTIFICATION, "}\n\n"),
+        ("if (device_id >= 2) {\n", REGULAR_DEVICE_IDENTIFICATION, "}\n"),
+    )),
+    EXTENDED_DEVICE_IDENTIFICATION: (CODE_READ_ID_EXTENDED_COUNT, (
+        ("if (device_id >= 1) {\n", BASIC_DEVICE_IDENTIFICATION, "}\n\n"),
+        ("if (device_id >= 2) {\n", REGULAR_DEVICE_IDENTIFICATION, "}\n\n"),
+        ("if (device_id == 3) {\n", EXTENDED_DEVICE_IDENTIFICATION, "}\n"),
+    )),
+}
+
 class Transition:
     """ Represents a test which triggers a callback or a transition """
+    __slots__ = ("matcher", "next", "set_crc")
+
     def __init__(self, matcher, next_state):
         self.matcher = matcher
         self.next = next_state
@@ -649,139 +866,152 @@ class Transition:
     def is_crc(self):
         return self.next is not None and isinstance(self.next.ops, Operation)
 
-    def to_code(self, indent):
-        tab = INDENT * indent
-        opening = close = ""
+    def to_code(self, indent, indent_str=INDENT):
         test = self.matcher.to_code()
-        has_test = test is not None
 
-        if has_test:
-            opening += f"if ( {test} ) {{\n{tab}{INDENT}"
-            close += f"\n{tab}}}"
-        else:
-            tab = ""
+        if test is None:
+            return False, CODE_GOTO.format(next=self.next.name)
 
-        return has_test, f"{opening}state = state_t::{self.next.name};{close}"
+        return True, CODE_TRANSITION.format(
+            test=test, tab=_tab(indent_str, indent), i=indent_str, next=self.next.name
+        )
 
 class TransitionGroup:
     """ Holds a group of matchers of the same type """
-    def __init__(self, integral, pos):
+    __slots__ = ("integral", "pos", "transitions", "indent_str")
+
+    def __init__(self, integral, pos, indent_str=INDENT):
         self.integral = integral
         self.pos = pos
         self.transitions = []
+        self.indent_str = indent_str
+
+    def is_switchable(self):
+        """ @return True if the group is a set of exact byte values worth a switch """
+        return self.integral.size == 1 and len(self.transitions) >= SWITCH_MIN_CASES and all(
+            isinstance(t.matcher.value, int) for t in self.transitions
+        )
+
+    def to_switch_code(self, tab):
+        """ Dispatch on the value of c rather than testing each value in turn """
+        error, state = NO_MATCH_ERRORS.get(self.pos, NO_MATCH_DEFAULT)
+        i = self.indent_str
+        parts = [CODE_SWITCH.format(tab=tab)]
+
+        for t in self.transitions:
+            parts.append(CODE_SWITCH_CASE.format(tab=tab, i=i, value=t.matcher.value, next=t.next.name))
+
+        parts.append(CODE_SWITCH_DEFAULT.format(tab=tab, i=i, error=error, state=state))
+
+        return "".join(parts)
 
     def to_code(self, indent):
-        tab = INDENT * indent
-        retval = str()
-        next_flag = False
+        i = self.indent_str
+        tab = _tab(i, indent)
         size = self.integral.size
+        cnt_check = CODE_CNT_CHECK.format(tab=tab, cnt=self.pos+size)
+
+        # Skip if CRC - we don't compute the CRC
+        if self.transitions[0].next.name.startswith('RDY_TO_CALL'):
+            return CODE_CRC_CHECK.format(
+                tab=tab, i=i, cnt=self.pos+size, next=self.transitions[0].next.name
+            )
+
+        if self.is_switchable():
+            return self.to_switch_code(tab)
+
         extra_indent = 1 if size > 1 else 0
-        extra = INDENT * extra_indent
+        prefix = _tab(i, indent + extra_indent)
         test_cnt = 0
-        data = str()
+        branches = []
 
-        # Skip if CRC - we don't compute the CRC
-        if not self.transitions[0].next.name.startswith('RDY_TO_CALL'):
-            if size == 2: # Redefine c
-                data = f"{tab}{extra}auto c = ntoh(cnt-2);\n\n"
-            elif size == 4:
-                data = f"{tab}{extra}auto c = ntohl(cnt-4);\n\n"
-
-            for matcher in self.transitions:
-                if next_flag:
-                    retval += " else "
-                else:
-                    retval += tab+extra
-
-                next_flag = True
-                has_test, to_append = matcher.to_code(indent+extra_indent)
-                retval += to_append
-                test_cnt += 1 if has_test else 0
-
-            if test_cnt > 0:
-                retval = data + retval + f" else {{"
-
-                if self.pos == 0:
-                    retval += f"\n{tab}{extra}{INDENT}error = error_t::ignore_frame;"
-                    retval += f"\n{tab}{extra}{INDENT}state = state_t::IGNORE;"
-                elif self.pos == 1:
-                    retval += f"\n{tab}{extra}{INDENT}error = error_t::illegal_function_code;"
-                    retval += f"\n{tab}{extra}{INDENT}state = state_t::ERROR;"
-                else:
-                    retval += f"\n{tab}{extra}{INDENT}error = error_t::illegal_data_value;"
-                    retval += f"\n{tab}{extra}{INDENT}state = state_t::ERROR;"
-            else:
-                pass
+        for matcher in self.transitions:
+            has_test, to_append = matcher.to_code(indent+extra_indent, i)
+            branches.append(to_append)
+            test_cnt += 1 if has_test else 0
 
-            if size == 1:
-                return retval
-        else:
-            t=self.transitions[0]
-            return f"{tab}if ( cnt == {self.pos+size} ) {{\n{tab}{INDENT}state = state_t::{t.next.name};"
+        parts = [cnt_check] if size > 1 else []
+
+        if test_cnt > 0:
+            error, state = NO_MATCH_ERRORS.get(self.pos, NO_MATCH_DEFAULT)
+            parts.append(CODE_REDEFINE_C.get(size, "").format(tab=prefix))
+            parts += [prefix, " else ".join(branches)]
+            parts.append(CODE_NO_MATCH.format(tab=prefix, i=i, error=error, state=state))
 
-        if ( test_cnt ):
-            return f"{tab}if ( cnt == {self.pos+size} ) {{\n{retval}\n{INDENT}{tab}}}"
+            if size > 1:
+                parts.append(f"\n{prefix}}}")
+        else:
+            parts += [prefix, " else ".join(branches)]
 
-        return f"{tab}if ( cnt == {self.pos+size} ) {{\n{retval}"
+        return "".join(parts)
 
 class Operation:
+    __slots__ = ("name", "prototype", "chain", "offsets")
+
     def __init__(self, name, prototype, chain):
         self.name = name
         self.prototype = prototype
         self.chain = chain
+        self.offsets = chain_offsets(chain)
 
     def to_code(self):
-        # Check the prototype to see if we need to pass the buffer data
-        # Create from the end
-        values_str = []
-        chain = [] + self.chain # Force a deep copy
-        nargs = len(self.prototype)
+        # The parameters are matched against the last items of the chain
+        arguments = []
+        first = len(self.chain) - len(self.prototype)
+
+        if first < 0:
+            raise ParsingException(f"Too many parameters for the command in {self.name}")
 
-        for pos, param in enumerate(reversed(self.prototype)):
+        for index, param in enumerate(self.prototype, first):
             if type(param) == tuple:
                 # Skip the name
                 param, param_name = param
                 param_name = f"'{param_name}'"
             else:
-                param_name = f"argument at position {nargs - pos}"
+                param_name = f"argument at position {index - first + 1}"
 
-            chain_item = chain.pop() # Pop the last element (and remove from length computation)
-            offset = sum(item.size for item in chain if isinstance(item, Integral))
-
-            param_size = param(0).size
+            chain_item = self.chain[index]
 
             # Make sure the size if compatible
             if not chain_item.fits(param):
                 raise ParsingException(f"Cannot fit {chain_item} into {param_name} of type {param.ctype} in {self.name}")
 
             # Compute offset for casts
-            offset += chain_item.size - param_size
+            arguments.append((param.size, self.offsets[index] + chain_item.size - param.size))
 
-            if param_size == 1:
-                values_str.insert(0, f"buffer[{offset}]")
-            elif param_size == 2:
-                values_str.insert(0, f"ntoh({offset})")
-            elif param_size == 4:
-                values_str.insert(0, f"ntohl({offset})")
+        return operation_call(self.name, tuple(arguments))
 
-        # Add the params (the list is ordered)
-        return f"{self.name}({', '.join(values_str)});"
+@functools.lru_cache(maxsize=512)
+def operation_call(name, arguments):
+    """ @return the call to the callback, given the size and offset of each argument """
+    values_str = (CODE_ARGUMENT[size].format(offset) for size, offset in arguments)
+    return f"{name}({', '.join(values_str)});"
 
 class NoOperation():
+    __slots__ = ()
+
     def to_code(self):
         return "// Reply is ignored"
 
 class State:
     """ State in the processing of incomming bytes """
-    def __init__(self, name, pos=0, mode="slave"):
+    __slots__ = ("name", "transition", "pos", "mode", "indent_str", "_by_matcher", "_transition_groups")
+
+    def __init__(self, name, pos=0, mode="slave", indent_str=INDENT):
         self.name = name
         self.transition = []
         self.pos = pos
         self.mode = mode
+        self.indent_str = indent_str
+        # Lookup of the transitions by matcher
+        self._by_matcher = {}
+        # Transitions grouped by matcher type. Set by finalize
+        self._transition_groups = {}
 
     def add(self, transition):
         """ Append a new transition to the current state """
         self.transition.append(transition)
+        self._by_matcher.setdefault(transition.matcher, transition)
 
     def next(self, alias):
         """ @return the name of the next state """
@@ -789,91 +1019,109 @@ class State:
         return self.name + "_" + alias
 
     def __add__(self, suffix):
-        return State(self.name + "_" + suffix, self.pos+1)
+        return State(self.name + "_" + suffix, self.pos+1, self.mode, self.indent_str)
 
     def is_final(self):
         return len(self.transition) and isinstance(Operation, self.transition[0])
 
     def has(self, matcher):
-        for transition in self.transition:
-            if transition.matcher == matcher:
-                return True
-        return False
+        return matcher in self._by_matcher
 
     def get_next_state_of(self, matcher):
         """ Given a matcher, return its transitioning state """
+        return self._by_matcher[matcher].next
+
+    def finalize(self):
+        """ Group the transitions by matcher type once the tree is complete """
+        self._transition_groups = {}
+
         for transition in self.transition:
-            if transition.matcher == matcher:
-                return transition.next
-        assert(False)
+            group = self._transition_groups.get(transition.matcher.__class__)
+
+            if group is None:
+                group = TransitionGroup(transition.matcher, self.pos, self.indent_str)
+                self._transition_groups[transition.matcher.__class__] = group
+
+            group.transitions.append(transition)
 
     def to_code_case(self, indent):
-        return f"{INDENT * indent}case state_t::{self.name}:\n"
+        return f"{_tab(self.indent_str, indent)}case state_t::{self.name}:\n"
 
     def to_code(self, indent):
-        # Group the transitions into groups by type
-        transition_groups = {}
-        tab = INDENT * indent
-        retval = str()
-
-        if self.pos == 0 and self.mode == "master":
-            retval += f"{tab}{INDENT}".join(["",
-                "// The address must match the address just send and still in the buffer\n",
-                "if ( c != buffer[0] ) {\n",
-                "    error = error_t::ignore_frame;\n",
-                "    state = state_t::IGNORE;\n",
-                "    break;\n",
-                "}\n"]
-            )
+        inner = _tab(self.indent_str, indent+1)
+        parts = []
 
-        if self.pos == 1 and self.mode == "master":
-            retval += f"{tab}{INDENT}".join(["",
-                "// The command must match the command just sent\n",
-                "if ( c == (0x80 | buffer[1]) ) { // Bit 7 indicate an error\n",
-                "   state = state_t::BAD_REQUEST;\n",
-                "   break;\n",
-                "} else if ( c != buffer[1] ) {\n",
-                "   state = state_t::ERROR;\n",
-                "   break;\n",
-                "}\n\n"]
-            )
+        if self.mode == "master" and self.pos in (0, 1):
+            parts.append(inner.join(["",
+                *(CODE_MASTER_ADDRESS_CHECK if self.pos == 0 else CODE_MASTER_COMMAND_CHECK)
+            ]))
 
-        for transition in self.transition:
-            group = transition_groups.setdefault(
-                transition.matcher.__class__,
-                TransitionGroup(transition.matcher, self.pos)
-            )
+        for tg in self._transition_groups.values():
+            parts.append(tg.to_code(indent+1))
 
-            group.transitions.append(transition)
-
-        for tg in transition_groups.values():
-            retval += tg.to_code(indent+1)
+        if any('{' in part for part in parts):
+            parts.append(f"\n{inner}}}")
 
-        if '{' in retval:
-            return retval + f"\n{tab}{INDENT}}}\n{tab}{INDENT}break;\n"
+        parts.append(f"\n{inner}break;\n")
 
-        return retval + f"\n{tab}{INDENT}break;\n"
+        return "".join(parts)
 
 
 class OperationState(State):
-    def __init__(self, op, name, pos=0):
-        super().__init__(name, pos)
+    __slots__ = ("op",)
+
+    def __init__(self, op, name, pos=0, indent_str=INDENT):
+        super().__init__(name, pos, indent_str=indent_str)
         self.op = op
 
     """ A state which leads to an operation """
     def to_code(self, indent):
-        tab = INDENT * indent
+        tab = _tab(self.indent_str, indent)
         return f"{tab}{self.op.to_code()}\n{tab}break;\n"
 
 class ParsingException(Exception):
     pass
 
+class Placeholders(dict):
+    """ Values of the template placeholders, computed and stripped on first use """
+    def __init__(self, getters):
+        super().__init__()
+        self.getters = getters
+
+    def __missing__(self, name):
+        value = self[name] = self.getters[name]().strip()
+        return value
+
 class CodeGenerator:
     """ Creates the C++ code to parse the modbus data """
-    def __init__(self, tree):
+    __slots__ = (
+        "indent_str", "counter", "mode", "namespace",
+        "states", "_op_states", "_non_op_states", "_rendered_states", "operations",
+        "_state_names", "_state_name_counts", "callbacks", "_proto_strings", "_pack_cache",
+        "max_buf_size", "buffer_index", "on_ready_reply_callback",
+        "device_address", "identification", "slave_id", "conformity_level",
+    )
+
+    def __init__(self, tree, tab_size=DEFAULT_TAB_SIZE):
+        # Indentation of the generated code
+        self.indent_str = " " * tab_size
         self.counter = 0
         self.states = []
+        # The states split by kind, in creation order
+        self._op_states = []
+        self._non_op_states = []
+        # Texts listing the states, by indent. Set by _render_states
+        self._rendered_states = {}
+        # Operation states by name and call
+        self.operations = {}
+        # All state names, and the number of states created from a given name
+        self._state_names = set()
+        self._state_name_counts = {}
         self.callbacks = {}
+        # C prototype of each callback
+        self._proto_strings = {}
+        # Packing code of the identification objects by indent, code and data
+        self._pack_cache = {}
         # Compute the maximum message size
         self.max_buf_size = 0
         # Buffer index
@@ -895,11 +1143,17 @@ class CodeGenerator:
         self.process_callbacks(tree["callbacks"])
 
         for key, value in tree.items():
-            if re.match(r"^device(@\d+)?$", key):
-                for cmd in value:
-                    self.max_buf_size = max(self.max_buf_size,
-                        sum(item.size for item in cmd if isinstance(item, Integral))
-                    )
+            if not key.startswith("device"):
+                continue
+
+            if DEVICE_KEY_RE.match(key):
+                self.max_buf_size = max(
+                    [self.max_buf_size] + [
+                        # Leave out the callback name ending the command
+                        chain_offsets(cmd[:-1] if isinstance(cmd[-1], str) else cmd)[-1]
+                        for cmd in value
+                    ]
+                )
 
         # Add space for the device address, the command and the CRC
         self.max_buf_size += 4
@@ -940,12 +1194,16 @@ class CodeGenerator:
             )
 
             # Add the callback for the report slave ID
-            self.callbacks["on_report_slave_id"] = []
+            self.register_callback("on_report_slave_id", [])
+
+            # Report all the invalid keys at once
+            bad_keys = self.identification.keys() - MEI_OBJECT_CATEGORY.keys()
+
+            if bad_keys:
+                names = ", ".join(str(k) for k in sorted(bad_keys, key=lambda k: (type(k).__name__, k)))
+                raise ParsingException(f"Invalid identification keys {names} in {self.mode} mode")
 
-            for keys in self.identification.keys():
-                if keys not in MEI_OBJECT_CATEGORY:
-                    raise ParsingException(f"Invalid identification key {keys} in {self.mode} mode")
-                self.conformity_level = max(self.conformity_level, MEI_OBJECT_CATEGORY[keys])
+            self.conformity_level = max(MEI_OBJECT_CATEGORY[key] for key in self.identification)
 
             # Insert the report slave ID function
             device.append(
@@ -959,10 +1217,10 @@ class CodeGenerator:
             )
 
             # Add the callback for the read device identification
-            self.callbacks["on_read_device_identification"] = [
+            self.register_callback("on_read_device_identification", [
                 (u8, "device_id"),
                 (u8, "object_id"),
-            ]
+            ])
 
             # Insert the diagnostic function
             device.append(
@@ -975,56 +1233,71 @@ class CodeGenerator:
             )
 
             # Add the callback for the diagnostic
-            self.callbacks["on_diagnostics"] = []
+            self.register_callback("on_diagnostics", [])
 
         self.process_devices(tree)
 
-    def new_state(self, new_state_name, pos):
-        """ Add a new state transition """
-        # Make sure the name is unique
-        names = {state.name for state in self.states if state.name.startswith(new_state_name)}
+        # The tree is complete
+        for state in self.states:
+            state.finalize()
+
+    def unique_name(self, new_state_name):
+        """ Reserve a state name, suffixed if needed to make it unique amongst the states """
+        count = self._state_name_counts.get(new_state_name, 0)
+        alt_name = new_state_name if count == 0 else new_state_name + "_" + str(count)
 
-        count = 1
-        alt_name = new_state_name
-        while alt_name in names:
+        # Guard against a name created with a suffix from another base name
+        while alt_name in self._state_names:
+            count += 1
             alt_name = new_state_name + "_" + str(count)
-            count+=1
 
-        new_state = State(alt_name, pos, self.mode)
+        self._state_name_counts[new_state_name] = count + 1
+        self._state_names.add(alt_name)
+
+        return alt_name
+
+    def new_state(self, new_state_name, pos):
+        """ Add a new state transition """
+        new_state = State(self.unique_name(new_state_name), pos, self.mode, self.indent_str)
         self.states.append(new_state)
+        self._non_op_states.append(new_state)
         return new_state
 
-    def generate_code(self):
-        placeholders = {
-            "DEVICE_ADDRESS" : self.get_device_address(2),
-            "set_device_address" : self.set_device_address(2),
-            "BUFSIZE" : str(self.max_buf_size),
-            "NAMESPACE" : self.namespace,
-            "ENUMS" : self.get_enums_text(2),
-            "CASES" : self.get_cases_text(3),
-            "CALLBACKS" : self.get_callbacks_text(2),
-            "INCOMPLETE": self.get_incomplete_text(2),
-            "PROTOTYPES" : self.get_prototypes(1),
-            "READY_REPLY_CALLBACK": self.get_ready_reply_callback(1),
-            "SLAVE_ID_FUNCTION": self.get_report_slave_id_function(1),
-            "SLAVE_READ_ID_REQUEST": self.get_read_device_identification(1),
-        }
-
-        # Function to replace each placeholder
-        def replace_placeholder(match):
-            linestart = match.group(1)
-            placeholder = match.group(2)
-            endl = match.group(3) or ""
+    def new_operation_state(self, op, new_state_name):
+        """ Add the state leading to an operation, shared by all commands making the same call """
+        key = (new_state_name, op.to_code())
 
-            # Call the corresponding method based on the placeholder name
-            return linestart + placeholders[placeholder].strip() + endl
+        if key not in self.operations:
+            new_state = OperationState(op, self.unique_name(new_state_name), 0, self.indent_str)
+            self.states.append(new_state)
+            self._op_states.append(new_state)
+            self.operations[key] = new_state
 
-        template = TEMPLATE_CODE_SLAVE if self.mode == "slave" else TEMPLATE_CODE_MASTER
+        return self.operations[key]
 
-        return re.sub(r"(\s*)@(.*?)@(\n?)", replace_placeholder, template )
+    def generate_code(self):
+        # Only the placeholders used by the template are computed
+        placeholders = Placeholders({
+            "DEVICE_ADDRESS" : lambda: self.get_device_address(2),
+            "set_device_address" : lambda: self.set_device_address(2),
+            "BUFSIZE" : lambda: str(self.max_buf_size),
+            "NAMESPACE" : lambda: self.namespace,
+            "ENUMS" : lambda: self.get_enums_text(2),
+            "CASES" : lambda: self.get_cases_text(2),
+            "CALLBACKS" : lambda: self.get_callbacks_text(2),
+            "INCOMPLETE": lambda: self.get_incomplete_text(2),
+            "PROTOTYPES" : lambda: self.get_prototypes(1),
+            "READY_REPLY_CALLBACK": lambda: self.get_ready_reply_callback(1),
+            "SLAVE_ID_FUNCTION": lambda: self.get_report_slave_id_function(1),
+            "SLAVE_READ_ID_REQUEST": lambda: self.get_read_device_identification(1),
+        })
+
+        template = FORMAT_TEMPLATE_SLAVE if self.mode == "slave" else FORMAT_TEMPLATE_MASTER
+
+        return template.format_map(placeholders)
 
     def get_device_address(self, indent):
-        tab = INDENT * indent
+        tab = _tab(self.indent_str, indent)
 
         if self.device_address is None:
             return f"""///< Runtime ID. Set-up before starting the modbus\n{tab}inline static uint8_t device_address = 255;"""
@@ -1033,19 +1306,46 @@ class CodeGenerator:
 
     def set_device_address(self, indent):
         if self.device_address is None:
-            tab = INDENT * indent
+            tab = _tab(self.indent_str, indent)
 
             return "///< Set the device address\n" + \
                 f"{tab}static inline void set_device_address(uint8_t new_address) {{\n" + \
-                f"{tab}{INDENT}device_address = new_address;\n" + \
+                f"{_tab(self.indent_str, indent+1)}device_address = new_address;\n" + \
                 f"{tab}}}"
 
         return ""
 
-    def get_enums_text(self, indent):
-        tab = INDENT * indent
+    def _render_states(self, indent):
+        """
+        Render all the texts listing the states in one go, rendering each case label once
+        @param indent Indentation of the enums. The cases are one level deeper
+        @return The enums, cases, incomplete cases and callbacks texts
+        """
+        if indent not in self._rendered_states:
+            tab = _tab(self.indent_str, indent)
+            cases, incomplete, default_cases, callbacks = [], [], [], []
+
+            for state in self._non_op_states:
+                case = state.to_code_case(indent+1)
+                cases += (case, state.to_code(indent+1))
+                incomplete.append(case)
+
+            for state in self._op_states:
+                case = state.to_code_case(indent+1)
+                default_cases.append(case)
+                callbacks += (case, state.to_code(indent+2))
+
+            self._rendered_states[indent] = (
+                ",\n".join(f"{tab}{state.name}" for state in self.states),
+                "".join(cases + default_cases),
+                "".join(incomplete),
+                "".join(callbacks),
+            )
 
-        return ",\n".join(f"{tab}{state.name}" for state in self.states)
+        return self._rendered_states[indent]
+
+    def get_enums_text(self, indent):
+        return self._render_states(indent)[0]
 
     def get_ready_reply_callback(self, indent):
         if self.on_ready_reply_callback:
@@ -1053,94 +1353,67 @@ class CodeGenerator:
         return ""
 
     def get_cases_text(self, indent):
-        state_code = str()
-
-        for state in self.states:
-            if isinstance(state, OperationState):
-                continue
-            state_code += state.to_code_case(indent)
-            state_code += state.to_code(indent)
-
-        # Create the default cases
-        for state in self.states:
-            if isinstance(state, OperationState):
-                state_code += state.to_code_case(indent)
-
-        return state_code
+        return self._render_states(indent)[1]
 
     def get_incomplete_text(self, indent):
-        state_code = str()
-
-        for state in self.states:
-            if not isinstance(state, OperationState):
-                state_code += state.to_code_case(indent+1)
-
-        return state_code
+        return self._render_states(indent)[2]
 
     def get_callbacks_text(self, indent):
-        state_code = str()
-
-        for state in self.states:
-            if isinstance(state, OperationState):
-                state_code += state.to_code_case(indent+1)
-                state_code += state.to_code(indent+2)
-
-        return state_code
+        return self._render_states(indent)[3]
 
     def get_prototypes(self, indent):
-        tab = INDENT * indent
-        retval = str()
-
-        for name, proto in self.callbacks.items():
-            retval += f"{tab}void {name}("
-
-            for cnt, param in enumerate(proto):
-                if isinstance(param, tuple):
-                    # Skip the name
-                    param, param_name = param
-                    param_name = " " + param_name
-                else:
-                    param_name = ""
-
-                comma = ", " if len(proto) - cnt > 1 else ""
-
-                retval += f"{param(0).ctype}{param_name}{comma}"
-
-            retval += ");\n"
+        tab = _tab(self.indent_str, indent)
+        parts = [f"{tab}{proto_string}\n" for proto_string in self._proto_strings.values()]
 
         if self.on_ready_reply_callback:
-            retval += f"{tab}void {self.on_ready_reply_callback}(std::string_view);";
+            parts.append(f"{tab}void {self.on_ready_reply_callback}(std::string_view);")
 
-        return retval
+        return "".join(parts)
 
     def process_callbacks(self, callback_list):
         """ Create a lookup for all the devices including param names """
         for cb, proto in callback_list.items():
-            # Check the cb name is C
-            if not VALID_C_FUNCTION_NAME.match(cb):
+            # Check the cb name is C - an ASCII identifier is [a-zA-Z_][a-zA-Z0-9_]*
+            if not (cb.isascii() and cb.isidentifier()):
                 raise ParsingException("Callback name is not a valid C function name")
 
-            self.callbacks[cb] = proto
+            self.register_callback(cb, proto)
+
+    def register_callback(self, cb, proto):
+        """ Add a callback, and build its C prototype """
+        params = []
+
+        for param in proto:
+            if isinstance(param, tuple):
+                param, param_name = param
+                params.append(f"{param.ctype} {param_name}")
+            else:
+                params.append(param.ctype)
+
+        self.callbacks[cb] = proto
+        self._proto_strings[cb] = f"void {cb}({', '.join(params)});"
 
     def process_devices(self, tree):
         """ Start the process with grouping all the devices """
         current_state = self.new_state("DEVICE_ADDRESS", 0)
 
         for key, value in tree.items():
-            if key == "device": # No ID attached - runtime ID
+            match = DEVICE_KEY_RE.match(key)
+
+            if match is None:
+                if key.startswith("device@"):
+                    raise ParsingException("Malformed device address")
+
+                continue
+
+            if match.group("addr") is None: # No ID attached - runtime ID
                 device_state = self.new_state(f"DEVICE", 1)
                 address_matcher = RuntimeDeviceAddress(alias=device_state.name)
                 current_state.add(Transition(address_matcher, device_state))
                 for command in value:
                     self.process_sequence(address_matcher, device_state, command)
-
-            if key.startswith("device@"):
-                match = re.search(DEVICE_ADDR_RE, key)
-
-                if not match:
-                    raise ParsingException("Malformed device address")
-
-                self.device_address = int(match.group(1), 0)
+            else:
+                self.device_address = int(match.group("addr"), 0)
 
                 if self.device_address > 254:
                     raise ParsingException("device address must be <= 254")
@@ -1157,12 +1430,20 @@ class CodeGenerator:
         pos = 1 # First byte
         callback = cmd[-1]
 
-        if type(callback) is not str:
-            cmd += ("NOTHING",)
-        elif callback not in self.callbacks:
-            raise ParsingException(f"Unknown callback {callback}: Callback must be declared first")
+        if isinstance(callback, str):
+            if callback not in self.callbacks:
+                raise ParsingException(f"Unknown callback {callback}: Callback must be declared first")
 
-        for index, matcher in enumerate(cmd):
+            command_name = callback
+            matchers = cmd[:-1]
+        else:
+            command_name = "NOTHING"
+            matchers = cmd
+
+        upper_name = command_name.upper()
+        last_index = len(matchers) - 1
+
+        for index, matcher in enumerate(matchers):
             # Size of the matcher
             pos += matcher.size
             matcher.pos = pos  # Set the position at which the matcher matches
@@ -1170,11 +1451,9 @@ class CodeGenerator:
             if state.has(matcher):
                 state = state.get_next_state_of(matcher)
             else:
-                if isinstance(cmd[index+1], str): # Command to follow?
-                    command_name = cmd[-1] # Grab the command name
-
+                if index == last_index: # Command to follow?
                     # Add the CRC state
-                    next_state = self.new_state(state.next("_" + command_name.upper() + "__CRC"), state.pos + matcher.size)
+                    next_state = self.new_state(state.next("_" + upper_name + "__CRC"), state.pos + matcher.size)
                     to_crc_transition = Transition(matcher, next_state)
                     to_crc_transition.set_crc = True
                     state.add(to_crc_transition)
@@ -1182,12 +1461,11 @@ class CodeGenerator:
 
                     # Add the final transition before making the call to the callback
                     if command_name != "NOTHING":
-                        op = Operation(command_name, self.callbacks[command_name], [address_matcher] + list(cmd[:-1]))
+                        op = Operation(command_name, self.callbacks[command_name], [address_matcher, *matchers])
                     else:
                         op = NoOperation()
 
-                    next_state = OperationState(op, "RDY_TO_CALL__" + command_name.upper(), 0)
-                    self.states.append(next_state)
+                    next_state = self.new_operation_state(op, "RDY_TO_CALL__" + upper_name)
                     crc_matcher = Crc(None)
                     state.add(Transition(crc_matcher, next_state))
                     break
@@ -1195,6 +1473,9 @@ class CodeGenerator:
                     next_state = self.new_state(state.next(matcher.alias), state.pos + matcher.size)
                     state.add(Transition(matcher, next_state))
                     state = next_state
+        else:
+            # The whole path already exists (or is empty), so the callback would never be reached
+            raise ParsingException(f"Command {cmd} overlaps an existing command path")
 
     def get_report_slave_id_function(self, level):
         # We need the product code as a minimum
@@ -1207,18 +1488,8 @@ class CodeGenerator:
         if MODEL_NAME in self.identification:
             id += f"_{self.identification[MODEL_NAME]}"
 
-        # Placeholder for actual implementation
-        tab = INDENT * level
-
-        return f"{tab}".join(["",
-            "\n/** Answer command 17 - Report slave id */\n",
-            "inline void on_report_slave_id() {\n",
-            "    Datagram::set_size(2); // Reset the count to 2 (ID + code)\n",
-            f"    Datagram::pack<uint8_t>({len(id)+2}); // Byte count\n",
-            f"    Datagram::pack<uint8_t>({self.slave_id}); // slave ID\n",
-            "    Datagram::pack<uint8_t>(0xFF); // Status OK\n",
-            f"    Datagram::pack(\"{id}\"); // Function code\n",
-            "}"]
+        return CODE_REPORT_SLAVE_ID.format(
+            tab=_tab(self.indent_str, level), length=len(id)+2, slave_id=self.slave_id, id=id
         )
 
     def get_read_device_identification(self, level):
@@ -1226,83 +1497,48 @@ class CodeGenerator:
         if self.conformity_level == 0:
             return ""
 
-        t0 = INDENT * (level)
-        t1 = INDENT * (level+1)
-        t2 = INDENT * (level+2)
+        t0, t1, t2 = (_tab(self.indent_str, level + n) for n in range(3))
 
-        def pack(code):
+        def pack(code, tab):
             """ Helper function to pack the key into the code """
             data = self.identification.get(code, "")
+            key = (tab, code, data)
 
-            return t2.join(["",
-                f"Datagram::pack<uint8_t>(0x{key:02x}); // Object code\n",
-                f"Datagram::pack<uint8_t>({len(data)}); // Length of the object\n",
-                f"Datagram::pack(\"{data}\");\n"]
-            )
+            if key not in self._pack_cache:
+                self._pack_cache[key] = CODE_PACK_OBJECT.format(
+                    tab=tab, code=code, length=len(data), data=data
+                )
+
+            return self._pack_cache[key]
 
-        # Placeholder for actual implementation
-        retval = t0.join(["",
-            "/** Answer command 43/14 */\n",
-            " inline void on_read_device_identification(uint8_t device_id, uint8_t object_id) {\n",
-            "    Datagram::set_size(4); // Reset the count to 4 (addr/func/mei_type/DevId)\n",
-            f"    Datagram::pack<uint8_t>({self.conformity_level}); // Conformity level\n",
-            "    Datagram::pack<uint8_t>(0); // No more to follow\n\n"
-            "    Datagram::pack<uint8_t>(0); // Next object ID\n\n"
-        ])
+        retval = CODE_READ_ID_HEADER.format(tab=t0, level=self.conformity_level)
 
-        all_objects = {}
-        device_id_count = {}
+        all_objects = defaultdict(list)
+        device_id_count = Counter()
 
         for key, identification in MEI_OBJECT_CATEGORY.items():
             if identification <= self.conformity_level and key in self.identification:
-                all_objects.setdefault(identification, []).append(pack(key))
-                device_id_count.setdefault(identification, 0)
+                all_objects[identification].append(key)
                 device_id_count[identification] += 1
 
-        if self.conformity_level == BASIC_DEVICE_IDENTIFICATION:
-            retval += t1.join(["",
-                "Datagram::pack<uint8_t>(0x03); // 3 objects\n",
-                *all_objects[BASIC_DEVICE_IDENTIFICATION]
-            ])
-        elif self.conformity_level == REGULAR_DEVICE_IDENTIFICATION:
-            retval += t1.join(["",
-                "if (device_id == 1) { // Device ID 1 has a fixed number of objects\n",
-                "   Datagram::pack<uint8_t>(0x03); // 3 objects\n",
-                "} else {\n",
-                f"   Datagram::pack<uint8_t>({3+device_id_count[REGULAR_DEVICE_IDENTIFICATION]}); // {3+device_id_count[REGULAR_DEVICE_IDENTIFICATION]} objects\n",
-                "}\n\n",
-                "if (device_id == 1) {\n",
-                *all_objects[BASIC_DEVICE_IDENTIFICATION],
-                "} else {\n",
-                *all_objects[REGULAR_DEVICE_IDENTIFICATION],
-                "}\n",
-            ])
-        elif self.conformity_level == EXTENDED_DEVICE_IDENTIFICATION:
-            l1c = device_id_count[BASIC_DEVICE_IDENTIFICATION]
-            l2c = device_id_count[REGULAR_DEVICE_IDENTIFICATION]
-            l3c = device_id_count[EXTENDED_DEVICE_IDENTIFICATION]
-
-            retval += t1.join(["",
-                f"if (device_id == 1) {{ // Device ID 1 has a fixed number of objects\n",
-                f"   Datagram::pack<uint8_t>({l1c}); // {l1c} objects\n",
-                "} else if (device_id == 2) {\n",
-                f"   Datagram::pack<uint8_t>({l1c+l2c}); // {l1c} + {l2c} objects\n",
-                "} else {\n",
-                f"   Datagram::pack<uint8_t>({l1c+l2c+l3c}); // {l1c} +  {l2c} + {l3c} objects\n",
-                "}\n\n",
-                "if (device_id >= 1) {\n"
-            ])
+        count_code, blocks = CONFORMITY_PLAN[self.conformity_level]
+        l1c = device_id_count[BASIC_DEVICE_IDENTIFICATION]
+        l2c = device_id_count[REGULAR_DEVICE_IDENTIFICATION]
+        l3c = device_id_count[EXTENDED_DEVICE_IDENTIFICATION]
 
-            retval += "".join(["", *all_objects[BASIC_DEVICE_IDENTIFICATION]])
-            retval += t1 + "}\n\n"
-            retval += t1 + "if (device_id >= 2) {\n"
-            retval += "".join(["", *all_objects[REGULAR_DEVICE_IDENTIFICATION]])
-            retval += t1 + "}\n\n"
-            retval += t1 + "if (device_id == 3) {\n"
-            retval += "".join(["", *all_objects[EXTENDED_DEVICE_IDENTIFICATION]])
-            retval += t1 + "}\n"
+        retval += count_code.format(
+            tab=t1, l1c=l1c, l2c=l2c, l3c=l3c, l2t=l1c+l2c, l3t=l1c+l2c+l3c
+        )
 
-        retval += t0.join(["","}\n"])
+        for opening, identification, closing in blocks:
+            if opening is None:
+                retval += "".join(pack(key, t1) for key in all_objects[identification])
+            else:
+                retval += t1 + opening
+                retval += "".join(pack(key, t2) for key in all_objects[identification])
+                retval += t1 + closing
+
+        retval += t0 + "}\n"
 
         return retval
 
@@ -1323,12 +1559,8 @@ class Modbus:
         )
         args = parser.parse_args()
 
-        # Override the tab size
-        global INDENT
-        INDENT = args.tab_size * ' '
-
         try:
-            gen = CodeGenerator(self.modbus)
+            gen = CodeGenerator(self.modbus, tab_size=args.tab_size)
             generated_code = gen.generate_code()
         except ParsingException as e:
             print( "Error: " + str(e) )
@@ -29,20 +29,6 @@ namespace asx {
          n_minus_1 = byte;
       }
 
-      void Crc::update(uint8_t byte) {
-         crc ^= (uint16_t)byte;
-
-         for (uint8_t j=8; j!=0; --j)
-         {
-            if (crc & 1) {
-               crc >>= 1;
-               crc ^= 0xA001;
-            } else {
-               crc >>= 1;
-            }
-         }
-      }
-
       bool Crc::check() {
          uint8_t msb = crc >> 8;
          uint8_t lsb = crc & 0xff;